@@ -2,7 +2,11 @@
 # TRE_json.py — core checks & report utilities used by TRE_ui.pyw / TRE_online.py
 
 import os, re, json, csv, html, datetime
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Optional
+try:
+    import re._parser as _sre_parse   # 3.11+
+except ImportError:
+    import sre_parse as _sre_parse
 
 # =====================
 # Globals / constants
@@ -19,6 +23,8 @@ def _dbg(msg: str):
 
 # Known junk tokens that sometimes bleed into payload
 _DENY_TOKENS = {"TELETELE", "AOTA", "CCU2s", "CCU2c"}
+# all tokens in one scan (none overlaps another, so this equals replacing them one by one)
+_sub_deny = re.compile("|".join(sorted(map(re.escape, _DENY_TOKENS), key=len, reverse=True))).sub
 
 # Tail fragments like =CCU2x / =ABC123x that get glued to payloads
 _re_tail_eq_tag = re.compile(r"=\s*[A-Z]{2,10}\d*[a-z]?\b")
@@ -26,6 +32,13 @@ _re_tail_eq_tag = re.compile(r"=\s*[A-Z]{2,10}\d*[a-z]?\b")
 # Utility regexes
 _ctrl_rx = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\u200b-\u200f\u202a-\u202e]")
 
+# Sanitizer passes (compiled once; bound .sub used per line)
+_sub_nonprint = re.compile(r"[^\x20-\x7e\t]+").sub   # printable ASCII + tab only
+_sub_caps_dup = re.compile(r"\b([A-Z]{3,10})(?:\1)+\b").sub   # OTAOTA -> OTA
+_sub_gtgt     = re.compile(r"\s*>>\s*").sub
+_sub_ws       = re.compile(r"\s+").sub
+_sub_tail_tag = _re_tail_eq_tag.sub
+
 # =====================
 # Generic text helpers
 # =====================
@@ -107,23 +120,22 @@ def sanitize_payload(payload: str) -> str:
     s = payload.replace("\r", " ").replace("\n", " ")
 
     # 2) printable only (keep tab/space)
-    s = "".join(ch for ch in s if (32 <= ord(ch) <= 126) or ch in "\t ")
+    s = _sub_nonprint("", s)
 
     # 3) known junk tokens
-    for tok in _DENY_TOKENS:
-        s = s.replace(tok, " ")
+    s = _sub_deny(" ", s)
 
     # 4) collapse repeated ALLCAPS (OTAOTA -> OTA)
-    s = re.sub(r"\b([A-Z]{3,10})(?:\1)+\b", r"\1", s)
+    s = _sub_caps_dup(r"\1", s)
 
     # 5) strip tail tags like '=CCU2x'
-    s = _re_tail_eq_tag.sub(" ", s)
+    s = _sub_tail_tag(" ", s)
 
     # 6) normalize spacing around >>
-    s = re.sub(r"\s*>>\s*", " >> ", s)
+    s = _sub_gtgt(" >> ", s)
 
     # 7) collapse whitespace
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _sub_ws(" ", s).strip()
     return s
 
 # keep old aliases working
@@ -148,120 +160,151 @@ def parse_dlt(line: str) -> Tuple[str, str, str, str]:
 # Matching
 # =====================
 
-def line_matches(line: str, cfg: dict) -> bool:
-    """
-    Payload-first matcher with robust 'literal + *** wildcard' support.
+def _flatten_printable(s: str) -> str:
+    if not s:
+        return ""
+    if s.isascii() and s.isprintable():
+        return s   # common case: nothing to flatten or drop
+    s = s.replace("\r", " ").replace("\n", " ")
+    return _sub_nonprint("", s)
 
-    Behavior:
-      - If cfg['literal'] == True, the pattern is treated literally except:
-          * '***' is a non-greedy wildcard ('.*?')
-          * spaces are flexible (one or more)
-          * '>>' spacing is flexible ('\\s*>>\\s*')
-      - If cfg['literal'] == False, treat pattern as a normal regex.
-      - Default matching is case-insensitive (can be flipped with ignore_case=False).
-      - If payload_only == True (default for ONLINE), we extract payload and sanitize it.
-      - We sanitize candidates: single physical line, printable only, remove '=CCU2...' tails,
-        collapse whitespace, normalize '>>' spacing.
-    """
+def _sanitize_local(s: str) -> str:
+    if not s:
+        return ""
+    s = _sub_deny(" ", s)
+    s = _sub_caps_dup(r"\1", s)
+    s = _sub_tail_tag(" ", s)
+    s = _sub_gtgt(" >> ", s)
+    s = _sub_ws(" ", s).strip()
+    return s
+
+def _literal_to_regex(p: str) -> str:
+    token = "___TRE_STARSTARSTAR___"
+    p = p.replace("***", token)
+    p = re.escape(p)
+    p = p.replace(re.escape(token), r".*?")
+    p = p.replace(r"\ ", r"\s+")
+    p = p.replace(r"\>\>", r"\s*>>\s*")
+    return p
+
+_rx_anchor_tok = re.compile(r"[A-Za-z0-9_]{3,}")
+# literal needles that sanitizing can never synthesize (no spaces/wildcards/'>>', no ALLCAPS runs)
+_rx_needle_ok  = re.compile(r"[!-~]+")
+_rx_caps_run   = re.compile(r"[A-Z]{3,}")
+_rx_word_run   = re.compile(r"\w+", re.ASCII)
+REQ_MIN_LEN    = 3
+
+def _required_word(pat: str, literal: bool, flags: int) -> Optional[str]:
+    """Longest word run ([A-Za-z0-9_]) every match must contain, lowercased; None if unknown.
+    Sanitizing never joins words, so on a clean ASCII line the run must be in the raw line too."""
+    if literal:
+        runs = _rx_word_run.findall(pat)
+    else:
+        runs = []; cur: List[str] = []
+        try:
+            items = list(_sre_parse.parse(pat, flags))
+        except Exception:
+            return None
+        for op, av in items:   # top-level sequence: each LITERAL item is mandatory
+            if op is _sre_parse.LITERAL and av < 128 and (chr(av).isalnum() or av == 95):
+                cur.append(chr(av)); continue
+            if cur: runs.append("".join(cur)); cur = []
+        if cur: runs.append("".join(cur))
+    best = max(runs, key=len, default="")
+    return best.lower() if len(best) >= REQ_MIN_LEN else None
+
+def prepare_cfg(cfg) -> Dict[str, Any]:
+    """Resolve a match cfg once (flags, compiled pattern, anchor) for repeated matching."""
     if not isinstance(cfg, dict):
         cfg = {"pattern": str(cfg), "literal": True}
 
-    pat         = str(cfg.get("pattern", "")) or ""
+    pat = str(cfg.get("pattern", "")) or ""
+    pc: Dict[str, Any] = {
+        "pattern":      pat,
+        "literal":      bool(cfg.get("literal", False)),
+        "equals":       bool(cfg.get("equals", False)),
+        "ignore_case":  cfg.get("ignore_case", True) is not False,
+        "payload_only": cfg.get("payload_only", True) is not False,
+        "use_anchor":   cfg.get("payload_anchor", True) is not False,
+        "pat_re":       None,
+        "anchor":       None,
+        "needle":       None,
+        "req":          None,
+    }
     if not pat:
-        return False
-
-    literal     = bool(cfg.get("literal", False))
-    equals      = bool(cfg.get("equals", False))
-    ignore_case = cfg.get("ignore_case", True) is not False
-    payload_only= cfg.get("payload_only", True) is not False
-    use_anchor  = cfg.get("payload_anchor", True) is not False
-
-    # --- helpers ---
-    def _flatten_printable(s: str) -> str:
-        if not s:
-            return ""
-        s = s.replace("\r", " ").replace("\n", " ")
-        return "".join(ch for ch in s if (32 <= ord(ch) <= 126) or ch in "\t ")
-
-    def _sanitize_local(s: str) -> str:
-        if not s:
-            return ""
-        for tok in _DENY_TOKENS:
-            s = s.replace(tok, " ")
-        s = re.sub(r"\b([A-Z]{3,10})(?:\1)+\b", r"\1", s)
-        s = _re_tail_eq_tag.sub(" ", s)
-        s = re.sub(r"\s*>>\s*", " >> ", s)
-        s = re.sub(r"\s+", " ", s).strip()
-        return s
-
-    def _build_candidates(src: str) -> list[str]:
-        raw = _flatten_printable(src)
-        cands: list[str] = []
-        if payload_only:
-            # 1) payload heuristic
-            cands.append(extract_payload(raw))
-            # 2) anchor slice (from first stable token in pattern)
-            if use_anchor:
-                m = re.search(r"[A-Za-z0-9_]{3,}", pat)
-                if m:
-                    anc = m.group(0)
-                    hay = raw if not ignore_case else raw.lower()
-                    ned = anc if not ignore_case else anc.lower()
-                    pos = hay.find(ned)
-                    if pos >= 0:
-                        cands.append(raw[pos:])
-            # 3) simple colon slice
-            p = raw.find(": ")
-            if 0 < p < 120:
-                cands.append(raw[p + 2 :].lstrip())
-        # 4) always include full raw
-        cands.append(raw)
-        # sanitize all
-        return [_sanitize_local(x) for x in cands]
-
-    def _literal_to_regex(p: str) -> str:
-        token = "___TRE_STARSTARSTAR___"
-        p = p.replace("***", token)
-        p = re.escape(p)
-        p = p.replace(re.escape(token), r".*?")
-        p = p.replace(r"\ ", r"\s+")
-        p = p.replace(r"\>\>", r"\s*>>\s*")
-        return p
-
-    # --- prepare pattern ---
-    pat_src = pat
-    flags = re.IGNORECASE if ignore_case else 0
+        return pc
 
-    if literal:
-        rx = _literal_to_regex(pat_src)
-        if equals:
+    flags = re.IGNORECASE if pc["ignore_case"] else 0
+    if pc["literal"]:
+        rx = _literal_to_regex(pat)
+        if pc["equals"]:
             rx = f"^{rx}$"
-        try:
-            pat_re = re.compile(rx, flags)
-        except re.error:
-            pat_re = None
     else:
-        try:
-            pat_re = re.compile(pat_src, flags)
-        except re.error:
-            pat_re = None
-
-    # --- candidates ---
-    candidates = _build_candidates(line)
+        rx = pat
+    try:
+        pc["pat_re"] = re.compile(rx, flags)
+    except re.error:
+        pc["pat_re"] = None
+
+    pc["req"] = _required_word(pat, pc["literal"], flags)
+
+    if (pc["literal"] and not pc["ignore_case"] and _rx_needle_ok.fullmatch(pat)
+            and "***" not in pat and ">>" not in pat and not _rx_caps_run.search(pat)):
+        pc["needle"] = pat
+
+    if pc["payload_only"] and pc["use_anchor"]:
+        m = _rx_anchor_tok.search(pat)
+        if m:
+            pc["anchor"] = m.group(0).lower() if pc["ignore_case"] else m.group(0)
+    return pc
+
+def _build_candidates(src: str, pc: Dict[str, Any]) -> List[str]:
+    raw = _flatten_printable(src)
+    cands: List[str] = []
+    if pc["payload_only"]:
+        # 1) payload heuristic
+        cands.append(extract_payload(raw))
+        # 2) anchor slice (from first stable token in pattern)
+        anc = pc["anchor"]
+        if anc:
+            hay = raw.lower() if pc["ignore_case"] else raw
+            pos = hay.find(anc)
+            if pos >= 0:
+                cands.append(raw[pos:])
+        # 3) simple colon slice
+        p = raw.find(": ")
+        if 0 < p < 120:
+            cands.append(raw[p + 2 :].lstrip())
+    # 4) always include full raw
+    cands.append(raw)
+    # sanitize all
+    return [_sanitize_local(x) for x in cands]
+
+def match_prepared(line: str, pc: Dict[str, Any]) -> bool:
+    pat_src = pc["pattern"]
+    if not pat_src:
+        return False
+    # fast reject: a clean ASCII line without the literal needle / required word cannot match any candidate
+    needle = pc["needle"]; req = pc["req"]
+    if (needle is not None or req is not None) and line.isascii() and line.isprintable():
+        if needle is not None and needle not in line:
+            return False
+        if req is not None and req not in line.lower():
+            return False
+    pat_re = pc["pat_re"]
+    ignore_case = pc["ignore_case"]
+    equals = pc["equals"]
 
     # --- try all ---
-    for idx, tgt in enumerate(candidates, 1):
+    for idx, tgt in enumerate(_build_candidates(line, pc), 1):
         try:
-            if literal:
-                if pat_re is not None:
-                    ok = pat_re.search(tgt) is not None
-                else:
-                    ok = (pat_src.lower() in tgt.lower()) if ignore_case else (pat_src in tgt)
+            if needle is not None:
+                # plain case-sensitive literal: str search, no regex engine
+                ok = (tgt == needle) if equals else (needle in tgt)
+            elif pat_re is not None:
+                ok = pat_re.search(tgt) is not None
             else:
-                if pat_re is not None:
-                    ok = pat_re.search(tgt) is not None
-                else:
-                    ok = (pat_src.lower() in tgt.lower()) if ignore_case else (pat_src in tgt)
+                ok = (pat_src.lower() in tgt.lower()) if ignore_case else (pat_src in tgt)
         except Exception:
             ok = False
 
@@ -273,6 +316,52 @@ def line_matches(line: str, cfg: dict) -> bool:
 
     return False
 
+def line_matches(line: str, cfg: dict) -> bool:
+    """
+    Payload-first matcher with robust 'literal + *** wildcard' support.
+
+    Behavior:
+      - If cfg['literal'] == True, the pattern is treated literally except:
+          * '***' is a non-greedy wildcard ('.*?')
+          * spaces are flexible (one or more)
+          * '>>' spacing is flexible ('\\s*>>\\s*')
+      - If cfg['literal'] == False, treat pattern as a normal regex.
+      - Default matching is case-insensitive (can be flipped with ignore_case=False).
+      - If payload_only == True (default for ONLINE), we extract payload and sanitize it.
+      - We sanitize candidates: single physical line, printable only, remove '=CCU2...' tails,
+        collapse whitespace, normalize '>>' spacing.
+    """
+    return match_prepared(line, prepare_cfg(cfg))
+
+def _batch_rejects(lines, pc: Dict[str, Any], start: int = 0) -> bool:
+    """True when no line of lines[start:] can match: one scan of the joined batch for the
+    needle / required word (neither holds a space, so no hit can span the ' ' joints)."""
+    needle = pc["needle"]; req = pc["req"]
+    if needle is None and req is None:
+        return False
+    blob = " ".join(lines[start:] if start else lines)
+    if not (blob.isascii() and blob.isprintable()):
+        return False   # per-line path decides
+    if needle is not None and needle not in blob:
+        return True
+    return req is not None and req not in blob.lower()
+
+def first_match_index_prepared(lines, pc: Dict[str, Any], start: int = 0):
+    """Same as first_match_index() for a cfg already resolved by prepare_cfg()."""
+    if not pc["pattern"] or _batch_rejects(lines, pc, start):
+        return None
+    for i in range(start, len(lines)):
+        if match_prepared(lines[i], pc):
+            return i
+    return None
+
+def first_match_index(lines, cfg: dict, start: int = 0):
+    """
+    Scan a batch of lines with one prepared cfg; return the 0-based index of the
+    first matching line (>= start) or None.
+    """
+    return first_match_index_prepared(lines, prepare_cfg(cfg), start)
+
 # =====================
 # Log reading
 # =====================
@@ -289,11 +378,12 @@ def iter_log(path: str):
 def check_find(lines: List[str], cfg: Dict[str, Any]) -> Dict[str, Any]:
     """ cfg: {pattern, literal?, min_count?} """
     minc = int(cfg.get("min_count", 1) or 1)
+    pc = prepare_cfg(cfg)
     count = 0
     first_line = None
     first_index = None
     for idx, line in enumerate(lines, start=1):
-        if line_matches(line, cfg):
+        if match_prepared(line, pc):
             count += 1
             if first_line is None:
                 first_line = line
@@ -307,12 +397,12 @@ def check_find(lines: List[str], cfg: Dict[str, Any]) -> Dict[str, Any]:
 
 def check_not_find(lines: List[str], cfg: Dict[str, Any]) -> Dict[str, Any]:
     """ cfg: {pattern, literal?} """
-    for idx, line in enumerate(lines, start=1):
-        if line_matches(line, cfg):
-            return {
-                "pass": False,
-                "detail": {"vc": cfg.get("pattern",""), "line": line, "index": idx}
-            }
+    hit = first_match_index(lines, cfg)
+    if hit is not None:
+        return {
+            "pass": False,
+            "detail": {"vc": cfg.get("pattern",""), "line": lines[hit], "index": hit + 1}
+        }
     return {"pass": True, "detail": {"vc": cfg.get("pattern","")}}
 
 def _norm_seq_elem(el, default_literal: bool) -> Dict[str, Any]:
@@ -335,13 +425,14 @@ def check_sequence(lines: List[str], step: Dict[str, Any]) -> Dict[str, Any]:
         raise ValueError("sequence must be a list")
     default_literal = bool(step.get("literal") or step.get("sequence_literal"))
     seq_norm = [_norm_seq_elem(el, default_literal) for el in seq]
+    seq_pc = [prepare_cfg(e) for e in seq_norm]
 
     pos = 0
     last_line = None
     for idx, line in enumerate(lines, start=1):
         if pos >= len(seq_norm):
             break
-        if line_matches(line, seq_norm[pos]):
+        if match_prepared(line, seq_pc[pos]):
             last_line = line
             pos += 1
             if pos == len(seq_norm):
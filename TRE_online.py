@@ -4,9 +4,10 @@
 # =====================================================================
 
 from __future__ import annotations
-import re, os, socket, time, datetime, traceback, subprocess, collections
+import re, os, errno, shutil, socket, time, traceback, subprocess, collections, queue, threading, atexit, random, select, selectors
 from typing import Dict, Any, List, Optional, Callable, Tuple, Deque
 from collections import deque
+from itertools import islice
 
 # Optional AI helper (safe no-op if missing)
 try:
@@ -18,6 +19,11 @@ except Exception:
     ai = _AIShim()
 
 import TRE_json as tre
+try:
+    import ahocorasick  # optional: one-pass literal prefilter for cumulative matching
+    AHO_OK = True
+except Exception:
+    AHO_OK = False
 try:
     import TRE_android as droid
     ANDROID_OK = True
@@ -36,33 +42,94 @@ MATCH_LOG_FILE   = os.path.join(LOGS_DIR, "match_debug.log")
 PAYLOAD_TAP_FILE = os.path.join(LOGS_DIR, "payload_tap.log")
 AI_LOG_FILE      = os.path.join(LOGS_DIR, "ai_debug.log")
 
-def _safe_open(path, mode):
+def _safe_open(path, mode, buffering=-1):
     try:
-        return open(path, mode, encoding="utf-8", errors="ignore")
-    except Exception:
+        return open(path, mode, buffering=buffering, encoding="utf-8", errors="ignore")
+    except OSError:
         return None
 
-wire_fh     = _safe_open(WIRE_TAP_FILE, "a")
-_match_fh   = _safe_open(MATCH_LOG_FILE, "a")
-_payload_fh = _safe_open(PAYLOAD_TAP_FILE, "a")
-_ai_fh      = _safe_open(AI_LOG_FILE, "a")
+def _write_pending(pend: Dict[Any, List[str]]) -> None:
+    """One write + flush per file for a batch of queued log text; empties pend."""
+    for fh, parts in pend.items():
+        try:
+            fh.write("".join(parts)); fh.flush()
+        except (OSError, ValueError):
+            pass
+    pend.clear()
+
+wire_fh     = _safe_open(WIRE_TAP_FILE, "a", buffering=256*1024)
+_match_fh   = _safe_open(MATCH_LOG_FILE, "a", buffering=65536)
+_payload_fh = _safe_open(PAYLOAD_TAP_FILE, "a", buffering=65536)
+_ai_fh      = _safe_open(AI_LOG_FILE, "a", buffering=65536)
+
+# AI log: callers enqueue, a daemon thread batches writes (flush ~1s and at shutdown);
+# only that thread touches _ai_fh
+AI_LOG_FLUSH_S = 1.0
+AI_LOG_UNBUFFERED = os.environ.get("AI_LOG_UNBUFFERED", "") not in ("", "0")
+_AI_Q: "queue.Queue[Optional[str]]" = queue.Queue()
+_ai_thr: Optional[threading.Thread] = None
+_ai_thr_lock = threading.Lock()
+
+def _ai_writer() -> None:
+    last_flush = time.monotonic(); dirty = False; stop = False
+    while not stop:
+        try:
+            batch = [_AI_Q.get(timeout=AI_LOG_FLUSH_S)]
+        except queue.Empty:
+            batch = []
+        try:
+            while True:
+                batch.append(_AI_Q.get_nowait())
+        except queue.Empty:
+            pass
+        parts: List[str] = []
+        for item in batch:
+            if item is None:
+                stop = True; continue
+            parts.append(item)
+        try:
+            if parts:
+                _ai_fh.write("".join(parts)); dirty = True
+            if dirty and (stop or AI_LOG_UNBUFFERED or time.monotonic() - last_flush >= AI_LOG_FLUSH_S):
+                _ai_fh.flush(); dirty = False; last_flush = time.monotonic()
+        except (OSError, ValueError):
+            pass
+
+def _ai_log_close() -> None:
+    global _ai_thr
+    with _ai_thr_lock:
+        thr, _ai_thr = _ai_thr, None
+    if thr:
+        _AI_Q.put(None); thr.join(timeout=2.0)
 
 def _ai_log(msg: str) -> None:
+    global _ai_thr
     if not _ai_fh:
         return
-    try:
-        _ai_fh.write(msg + ("\n" if not msg.endswith("\n") else ""))
-        _ai_fh.flush()
-    except Exception:
-        pass
+    if _ai_thr is None:
+        with _ai_thr_lock:
+            if _ai_thr is None:
+                _ai_thr = threading.Thread(target=_ai_writer, name="tre-ai-log", daemon=True)
+                _ai_thr.start()
+    _AI_Q.put(msg + ("\n" if not msg.endswith("\n") else ""))
+
+atexit.register(_ai_log_close)
 
 # === CHUNK 1 — Engine tunables ======================================
 CONNECT_TIMEOUT_SEC    = 5.0
 RECV_BLOCK_BYTES       = 65536
+RECV_BATCH_BYTES       = 1 << 20   # max bytes read per readiness wake-up
+SOCK_RCVBUF_BYTES      = 1 << 20
+KEEPALIVE_IDLE_S       = 10   # probe a silent peer after 10s, every 5s, give up after 3 misses
+KEEPALIVE_INTVL_S      = 5
+KEEPALIVE_CNT          = 3
 RETRY_MAX_ATTEMPTS     = 5
 RETRY_BACKOFF_BASE_S   = 0.5
+RETRY_BACKOFF_CAP_S    = 30.0
+CONNECT_RETRY_BUDGET_S = 30.0   # total wall time for one connect-with-retries round
+CONNECT_CANCEL_POLL_S  = 0.1    # how often a pending connect checks for stop()
 SETTLE_DELAY_S         = 3.0
-RING_BUFFER_MAX_LINES  = 20000
+RING_BUFFER_MAX_BYTES  = 4 << 20   # settle/pause capture (raw bytes, oldest dropped)
 
 STEP1_TIMEOUT_S        = 0.0
 DEFAULT_STEP_TIMEOUT_S = 0.0   # default: no auto timeout unless specified
@@ -70,6 +137,7 @@ TIMEOUT_TICK_INTERVAL  = 0.5
 
 IDLE_TICK_S            = 0.20
 WAIT_DRAIN_TICK_S      = 0.05
+STOP_DRAIN_S           = 0.05
 
 FORCE_PAYLOAD_ONLY     = True
 VERIFY_SEQUENTIAL      = True
@@ -84,33 +152,280 @@ AUTO_RECONNECT         = True
 RECONNECT_MAX          = 3
 RECONNECT_DELAY_S      = 1.0
 DEBUG_DUMP_LAST_LINES = 60
+PAYLOAD_FLUSH_BYTES    = 65536   # log writer: write + flush once this much is pending ...
+PAYLOAD_FLUSH_S        = 0.10    # ... or this often (wire tap, payload tap, match debug)
 
 def _now_s() -> float:
     return time.monotonic()
 
+# log timestamps carry second resolution: format once per wall-clock second
+_LAST_TS: List[Any] = [-1, ""]
+
+def _ts_cached() -> str:
+    sec = int(time.time())
+    if sec != _LAST_TS[0]:
+        _LAST_TS[:] = [sec, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec))]
+    return _LAST_TS[1]
+
+# resolver failures that retrying cannot fix (EAI_AGAIN stays retryable)
+_PERMANENT_GAI_ERRS = {getattr(socket, n) for n in ("EAI_NONAME","EAI_SERVICE","EAI_FAMILY","EAI_FAIL","EAI_BADFLAGS")
+                       if hasattr(socket, n)}
+
+def _is_permanent_connect_error(e: BaseException) -> bool:
+    return isinstance(e, socket.gaierror) and e.errno in _PERMANENT_GAI_ERRS
+
+def _tune_socket(sock: socket.socket) -> None:
+    """Set once before connect (SO_RCVBUF must precede the handshake to size the window)."""
+    opts = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            (socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_RCVBUF_BYTES),
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # keepalive timers (platform permitting) so a rebooted device is noticed in ~25s, not ~2h
+    for name, val in (("TCP_KEEPIDLE", KEEPALIVE_IDLE_S), ("TCP_KEEPINTVL", KEEPALIVE_INTVL_S),
+                      ("TCP_KEEPCNT", KEEPALIVE_CNT)):
+        opt = getattr(socket, name, None)
+        if opt is not None:
+            opts.append((socket.IPPROTO_TCP, opt, val))
+    for level, opt, val in opts:
+        try:
+            sock.setsockopt(level, opt, val)
+        except OSError:
+            pass
+
+_CONNECT_PENDING = {c for c in (getattr(errno, n, None) for n in
+                    ("EINPROGRESS", "EWOULDBLOCK", "EAGAIN", "WSAEWOULDBLOCK", "WSAEINPROGRESS")) if c is not None}
+
+def _connect_any(host: str, port: int, timeout: float,
+                 cancel: Optional[threading.Event] = None) -> socket.socket:
+    """Non-blocking connect to every resolved address at once; first to complete wins
+    (returned non-blocking and tuned), the rest are closed. Raises the last OSError;
+    a set `cancel` event aborts the wait within CONNECT_CANCEL_POLL_S."""
+    pending: Dict[socket.socket, Any] = {}; seen = set()
+    last_err: Optional[OSError] = None; winner: Optional[socket.socket] = None
+    try:
+        for fam, typ, proto, _, addr in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+            if addr in seen:
+                continue
+            seen.add(addr)
+            s = socket.socket(fam, typ, proto)
+            try:
+                _tune_socket(s); s.setblocking(False)
+                rc = s.connect_ex(addr)
+            except OSError as e:
+                s.close(); last_err = e; continue
+            if rc == 0:
+                winner = s; break
+            if rc not in _CONNECT_PENDING:
+                s.close(); last_err = OSError(rc, os.strerror(rc)); continue
+            pending[s] = addr
+        end = _now_s() + timeout
+        while winner is None and pending:
+            rem = end - _now_s()
+            if rem <= 0:
+                last_err = socket.timeout("timed out"); break
+            if cancel is not None and cancel.is_set():
+                last_err = OSError(errno.ECANCELED, "connect cancelled"); break
+            socks = list(pending)
+            _, w, x = select.select([], socks, socks, min(rem, CONNECT_CANCEL_POLL_S))   # Windows reports failures in x
+            for s in set(w) | set(x):
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                del pending[s]
+                if err == 0 and winner is None:
+                    winner = s
+                else:
+                    s.close()
+                    if err: last_err = OSError(err, os.strerror(err))
+    finally:
+        for s in pending:
+            s.close()
+    if winner is None:
+        raise last_err or OSError(f"no address for {host}:{port}")
+    return winner
+
+def _shutdown_socket(sock: socket.socket) -> None:
+    """shutdown() once, drain what is already queued within STOP_DRAIN_S, then close."""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    end=_now_s()+STOP_DRAIN_S; scratch=None
+    try:
+        while True:
+            rem=end-_now_s()
+            if rem<=0: break
+            if not select.select([sock],[],[],rem)[0]: break
+            if scratch is None: scratch=bytearray(RECV_BLOCK_BYTES)
+            if not sock.recv_into(scratch): break
+    except (OSError,ValueError):
+        pass
+    try:
+        sock.close()
+    except OSError:
+        pass
+
 # === CHUNK 2 — LineRing =============================================
+def _split_lines(text: str) -> List[str]:
+    """Split a decoded batch on '\n'; per-line CR strip only when the batch has a CR at all."""
+    if "\r" not in text:
+        return text.split("\n")
+    return [ln.rstrip("\r") for ln in text.split("\n")]
+
 class LineRing:
-    def __init__(self, max_lines: int = RING_BUFFER_MAX_LINES):
-        self._dq: Deque[str] = collections.deque(maxlen=max_lines)
+    """Preallocated byte ring for raw stream data; lines are split/decoded only on drain()."""
+    def __init__(self, max_bytes: int = RING_BUFFER_MAX_BYTES):
+        self._cap=max(1024,int(max_bytes))
+        self._mem=bytearray(self._cap); self._mv=memoryview(self._mem)
+        self._head=0; self._size=0; self._dropped=False
+    def write(self, data) -> None:
+        cap=self._cap; n=len(data)
+        if n>=cap:
+            data=data[n-cap:]; n=cap; self._head=0; self._size=0; self._dropped=True
+        over=self._size+n-cap
+        if over>0:
+            self._head=(self._head+over)%cap; self._size-=over; self._dropped=True
+        tail=(self._head+self._size)%cap
+        first=min(n,cap-tail)
+        self._mv[tail:tail+first]=data[:first]
+        if n>first:
+            self._mv[0:n-first]=data[first:]
+        self._size+=n
     def append(self, line: str) -> None:
-        self._dq.append(line)
+        self.write((line+"\n").encode("utf-8","ignore"))
+    def extend(self, lines: List[str]) -> None:
+        """Batch of lines in one encode + write."""
+        if lines:
+            self.write(("\n".join(lines)+"\n").encode("utf-8","ignore"))
+    def _take(self) -> bytes:
+        h=self._head; n=self._size; cap=self._cap
+        raw=bytes(self._mv[h:h+n]) if h+n<=cap else bytes(self._mv[h:])+bytes(self._mv[:h+n-cap])
+        self._head=0; self._size=0
+        return raw
     def drain(self) -> List[str]:
-        out = list(self._dq); self._dq.clear(); return out
+        """Complete lines (oldest first); a partial tail stays buffered for drain_partial()."""
+        raw=self._take(); start=0
+        if self._dropped:
+            # oldest line was cut by wrap-around; resync on the next newline
+            p=raw.find(b"\n"); start=p+1 if p>=0 else len(raw); self._dropped=False
+        end=raw.rfind(b"\n",start)
+        mv=memoryview(raw)   # offsets instead of slicing copies of the flush
+        if max(end+1,start)<len(raw):
+            self.write(mv[max(end+1,start):])
+        if end<0:
+            return []
+        # one decode for the whole flush ('\n' never occurs inside a UTF-8 sequence)
+        text=str(mv[start:end],"utf-8","ignore")
+        return _split_lines(text)
+    def drain_partial(self) -> bytes:
+        return self._take()
+    def drop_partial(self) -> bytes:
+        """Cut an unterminated tail off the ring (returned); complete lines stay buffered."""
+        raw=self._take(); end=raw.rfind(b"\n")+1
+        if end:
+            self.write(memoryview(raw)[:end])
+        return raw[end:]
     def __len__(self):
-        return len(self._dq)
+        return self._size
 
 # === CHUNK 3 — ADB fallback =========================================
+ADB_SHELL_SENTINEL = "__TRE_RC__"
+ADB_SHELL_TIMEOUT_S = 3.0   # per command once written (first use also covers the shell's connect)
+
 class _AdbDirect:
     def __init__(self, exe: str = "adbb"):
         self.exe = exe
+        # persistent `adbb shell` coprocess (started lazily, one per instance)
+        self._shell: Optional[subprocess.Popen] = None
+        # each coprocess gets its own queue; items are (proc, line), line None = EOF
+        self._shell_q: "queue.Queue[Tuple[subprocess.Popen, Optional[str]]]" = queue.Queue()
+        self._shell_lock = threading.Lock()
+        self._wm: Optional[Tuple[int,int]] = None
+
+    def _shell_reader(self, proc: subprocess.Popen, q: "queue.Queue") -> None:
+        # bound to its own process's queue: a killed shell cannot post into its successor's
+        try:
+            for raw in iter(proc.stdout.readline, b""):
+                q.put((proc, raw.decode("utf-8","ignore").rstrip("\r\n")))
+        except (OSError, ValueError):
+            pass
+        q.put((proc, None))
+        # the reader owns stdout: close it here (closing from another thread would block on readline)
+        try: proc.stdout.close()
+        except OSError: pass
+        try: proc.wait(timeout=5.0)
+        except subprocess.TimeoutExpired: pass
+
+    def _shell_kill(self) -> None:
+        proc, self._shell = self._shell, None
+        if proc:
+            try: proc.kill()
+            except OSError: pass
+            try: proc.stdin.close()
+            except OSError: pass
+            try: proc.wait(timeout=1.0)   # reap; the reader thread reaps later if this times out
+            except subprocess.TimeoutExpired: pass
+
+    def shell(self, cmd: str, timeout: float = ADB_SHELL_TIMEOUT_S) -> Optional[Tuple[int,List[str]]]:
+        """Run one command in the persistent shell. None = never sent (spawn/write failed), safe to
+        retry elsewhere; (-1, output) = sent but no result (timeout/EOF), must not be resent."""
+        with self._shell_lock:
+            if self._shell is None or self._shell.poll() is not None:
+                try:
+                    self._shell = subprocess.Popen([self.exe,"shell"], stdin=subprocess.PIPE,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+                except OSError:
+                    self._shell = None; return None
+                self._shell_q = queue.Queue()
+                threading.Thread(target=self._shell_reader, args=(self._shell, self._shell_q), daemon=True).start()
+            try:
+                self._shell.stdin.write(f"{cmd}; echo {ADB_SHELL_SENTINEL}$?\n".encode("utf-8"))
+                self._shell.stdin.flush()
+            except OSError:
+                self._shell_kill(); return None
+            proc = self._shell; q = self._shell_q
+            out: List[str] = []; end = _now_s() + timeout
+            while True:
+                try:
+                    src, ln = q.get(timeout=max(0.0, end - _now_s()))
+                except queue.Empty:
+                    self._shell_kill(); return -1, out   # stuck: output state unknown, start fresh next time
+                if src is not proc:
+                    continue   # stale item from an earlier coprocess
+                if ln is None:
+                    self._shell_kill(); return -1, out
+                if ln.startswith(ADB_SHELL_SENTINEL):
+                    try: return int(ln[len(ADB_SHELL_SENTINEL):] or 1), out
+                    except ValueError: return 1, out
+                out.append(ln)
+
+    def close(self) -> None:
+        with self._shell_lock:
+            self._shell_kill()
+
+    def wm_size(self) -> Tuple[int,int]:
+        """Physical screen size via the shell; cached after the first good answer."""
+        if self._wm:
+            return self._wm
+        res = self.shell("wm size")
+        if res:
+            for ln in res[1]:
+                if ":" in ln and "x" in ln:
+                    try:
+                        w,h = ln.split(":",1)[1].strip().split("x")
+                        self._wm = (int(w),int(h)); return self._wm
+                    except ValueError:
+                        pass
+        return (0,0)
+
     def tap(self, x:int, y:int)->bool:
+        res = self.shell(f"input tap {int(x)} {int(y)}")
+        if res is not None:
+            return res[0] == 0   # sent: the tap may have landed, so never resend it
         for cmd in ([self.exe,"t",str(x),str(y)],
                     [self.exe,"shell","input","tap",str(x),str(y)]):
             try:
                 r=subprocess.run(cmd,timeout=1.5,
                                  stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
                 if r.returncode==0: return True
-            except Exception:
+            except (OSError, subprocess.SubprocessError):
                 continue
         return False
     def screencap_png_to(self,out_file:str)->bool:
@@ -119,7 +434,7 @@ class _AdbDirect:
                 r=subprocess.run([self.exe,"exec-out","screencap","-p"],
                                  timeout=4.0,stdout=f,stderr=subprocess.DEVNULL)
             return r.returncode==0 and os.path.exists(out_file) and os.path.getsize(out_file)>0
-        except Exception:
+        except (OSError, subprocess.SubprocessError):
             return False
 
 # === CHUNK 4 — SessionManager =======================================
@@ -135,14 +450,29 @@ class SessionManager:
         self.on_step_update=on_step_update or (lambda i,n,v,r,l:None)
 
         self._sock=None; self._running=False; self._paused=False
-        self._buf=""; self._ring=LineRing()
+        self._buf=bytearray(); self._buf_scanned=0; self._ring=LineRing()
+        self._rxbuf=bytearray(RECV_BLOCK_BYTES); self._rxview=memoryview(self._rxbuf)
         self._matching_enabled=False
-        self._prefeed_lines: List[str] = []
+        self._in_lines: Deque[str] = deque()
+        self._stop_evt = threading.Event()   # set by stop(): aborts connect waits and backoff
         self._payload_history: Deque[str] = deque(maxlen=5000)
+        self._hist_total=0                    # lines ever appended to _payload_history
+        self._scan_pos: Dict[int, int] = {}   # step idx -> absolute history position already scanned
         self._action_ptr=1
         self._dev_w=0; self._dev_h=0; self._adb=_AdbDirect("adbb")
         self._hist: Dict[int, Deque[str]] = {}
+        # cumulative mode: every live step sees the same lines, so they share one recent-payload
+        # window and a step's history is snapshotted from it when the step finishes
+        self._hist_live: Deque[str] = deque(maxlen=HISTORY_MAX_PER_STEP)
         self._counts: Dict[int, int] = {}
+        self._log_q: "queue.SimpleQueue[Optional[Tuple[Any, str]]]" = queue.SimpleQueue()
+        self._log_thr: Optional[threading.Thread] = None
+        self._aho = None
+        self._sel: Optional[selectors.BaseSelector] = None
+        self._sel_sock: Optional[socket.socket] = None
+        self._wake_r: Optional[socket.socket] = None; self._wake_w: Optional[socket.socket] = None
+        self._live: List[int] = []   # 0-based indices of unfinished steps, ascending
+        self._dl_next: Optional[float] = None; self._dl_dirty = True   # cached nearest live deadline
     def _dump_debug_sample(self, idx: int, name: str, reason: str, limit: int = DEBUG_DUMP_LAST_LINES):
         """Write a small debug file with recent RAW lines to help analyze a failure."""
         try:
@@ -171,14 +501,42 @@ class SessionManager:
         return False
 
     def _dbg(self, msg: str) -> None:
-        if not _match_fh:
-            return
+        if _match_fh:
+            self._log_put(_match_fh, "[%s] %s\n" % (_ts_cached(), msg))
+
+    # ---- Log writer (background): wire tap, payload tap, match debug
+    def _log_put(self, fh, text: str) -> None:
+        """Hand text to the writer thread; written inline only when no session is running it."""
+        if self._log_thr:
+            self._log_q.put((fh, text)); return
         try:
-            _match_fh.write(f"[{datetime.datetime.now():%Y-%m-%d %H:%M:%S}] {msg}\n")
-            _match_fh.flush()
-        except Exception:
+            fh.write(text)
+        except (OSError, ValueError):
             pass
 
+    def _log_writer(self) -> None:
+        pend: Dict[Any, List[str]] = {}; size=0; last_flush=_now_s()
+        while True:
+            try:
+                item=self._log_q.get(timeout=PAYLOAD_FLUSH_S)
+            except queue.Empty:
+                item=()
+            if item is None:
+                break
+            if item:
+                fh, text = item
+                parts=pend.get(fh)
+                if parts is None: parts=pend[fh]=[]
+                parts.append(text); size+=len(text)
+            if pend and (size>=PAYLOAD_FLUSH_BYTES or _now_s()-last_flush>=PAYLOAD_FLUSH_S):
+                _write_pending(pend); size=0; last_flush=_now_s()
+        _write_pending(pend)
+
+    def _stop_log_writer(self) -> None:
+        thr=self._log_thr; self._log_thr=None
+        if thr:
+            self._log_q.put(None); thr.join(timeout=2.0)
+
     # ---- Lifecycle
     def pause(self):
         self._paused=True;  self.on_status("Paused.")
@@ -186,41 +544,48 @@ class SessionManager:
         self._paused=False; self.on_status("Resumed.")
     def stop(self):
         self._running=False; self._paused=False
-        self._buf=""; self._ring.drain(); self._prefeed_lines.clear()
-        try:
-            if self._sock:
-                try:
-                    self._sock.shutdown(socket.SHUT_RDWR)
-                except Exception:
-                    pass
-                try:
-                    self._sock.close()
-                except Exception:
-                    pass
-        finally:
-            self._sock=None
+        # signal only: buffers belong to the engine thread and are reset in start()'s finally
+        self._stop_evt.set(); self._wake()
+        sock, self._sock = self._sock, None
+        if sock:
+            _shutdown_socket(sock)
 
     # ---- Start
     def start(self):
         for t in self.tests:
-            for k in ("_done","_seq_idx","_t0","_count","_final_result","_final_line"):
+            for k in ("_done","_seq_idx","_t0","_count","_final_result","_final_line","_vc","_pc","_seq_pc","_deadline","_name","_need","_on_timeout"):
                 t.pop(k,None)
-        self._ring=LineRing(); self._matching_enabled=False; self._action_ptr=1
-        self._hist.clear(); self._counts.clear(); self._payload_history.clear()
+        self._ring.drain_partial(); self._matching_enabled=False; self._action_ptr=1
+        self._stop_evt.clear()
+        self._hist.clear(); self._hist_live.clear(); self._counts.clear(); self._payload_history.clear()
+        self._hist_total=0; self._scan_pos.clear()
+        if (wire_fh or _payload_fh or _match_fh) and not self._log_thr:
+            self._log_thr=threading.Thread(target=self._log_writer, daemon=True)
+            self._log_thr.start()
 
         s=self._connect_with_retries()
         if not s:
+            self._stop_log_writer()
             self.on_status("Failed to connect.")
             return
         self._sock=s; self._running=True; self.on_status("Connected.")
+        self._open_selector()
 
         now=time.monotonic()
         for i,t in enumerate(self.tests, start=1):
-            t.update({"_done":False,"_seq_idx":0,"_t0":now,"_count":0})
-            self._hist[i]=collections.deque(maxlen=HISTORY_MAX_PER_STEP)
+            t.update({"_done":False,"_seq_idx":0,"_t0":now,"_count":0,"_vc":self._describe_vc(t),
+                      "_name":t.get("name",f"Step {i}")})
+            self._compile_step(t)
+            tmo=self._current_timeout_s(i,t); t["_deadline"]=(now+tmo) if tmo>0 else None
+            t["_on_timeout"]=self._timeout_outcome(t,tmo)
+            if VERIFY_SEQUENTIAL:
+                self._hist[i]=collections.deque(maxlen=HISTORY_MAX_PER_STEP)
             self._counts[i]=0
+        self._aho=self._build_needle_automaton()
+        self._live=list(range(len(self.tests))); self._dl_dirty=True
 
-        steps_info=[{"idx":i,"name":t.get("name",f"Step {i}"),"vc":self._describe_vc(t)} for i,t in enumerate(self.tests,1)]
+        # (idx, name, vc) per step
+        steps_info=tuple((i,t["_name"],t["_vc"]) for i,t in enumerate(self.tests,1))
         try:
             self.on_steps_init(steps_info)
         except Exception:
@@ -229,12 +594,12 @@ class SessionManager:
         settle_until=_now_s()+SETTLE_DELAY_S
         self.on_status(f"Settling {SETTLE_DELAY_S:.1f}s…")
         try:
-            while self._running and _now_s()<settle_until:
-                self._drain_to_ring(); time.sleep(IDLE_TICK_S)
+            # idle: one selector wait; bursts: drained into the ring once per coalescing tick
+            self._wait_drain(settle_until, self._drain_to_ring)
         except Exception as e:
             self.on_status(f"Settle error: {e}")
 
-        pre_lines=self._ring.drain()
+        pre_lines=self._ring.drain(); self._buf[:0]=self._ring.drain_partial(); self._buf_scanned=0
         self.on_status(f"Feeding {len(pre_lines)} buffered lines…")
         for ln in pre_lines:
             if not self._running: break
@@ -243,54 +608,61 @@ class SessionManager:
         self._matching_enabled=True
         self.on_status("Live matching started.")
         disconnects=0
-        last_timeout_check=_now_s()
+        last_scan=0.0; last_scan_idx=None; rescan=False
 
         try:
+            # bound once: the loop runs per recv batch for the whole session
+            inq=self._in_lines; popleft=inq.popleft; dispatch=self._process_line_dispatch
+            recv_block=self._recv_block; wait_readable=self._wait_readable; take_lines=self._take_lines
+            next_deadline=self._next_deadline
             while self._running:
-                # prefeed (wait_capture)
-                while self._prefeed_lines and self._running and not self._paused:
-                    ln=self._prefeed_lines.pop(0)
-                    self._process_line_dispatch(ln)
-
-                text=self._recv_block()
-                if text is None:
-                    if AUTO_RECONNECT and disconnects<RECONNECT_MAX:
+                # block until data or the nearest step deadline (bounded by the timeout tick)
+                wait=TIMEOUT_TICK_INTERVAL; dl=next_deadline()
+                if dl is not None:
+                    wait=max(0.0,min(wait,dl-_now_s()))
+                if (inq and not self._paused) or rescan:
+                    wait=0.0   # queued input (e.g. wait_capture) or a pending history catch-up goes first
+                got=recv_block() if wait_readable(wait) else 0
+
+                if got:
+                    lines=take_lines()
+                    if wire_fh and lines:
+                        self._log_put(wire_fh, "\n".join(lines)+"\n")   # one item per recv batch
+                    if self._paused:
+                        self._ring.extend(lines)
+                    else:
+                        inq.extend(lines)
+
+                # one input queue: wait_capture prefeed (at the front) then live lines, in order
+                while inq and self._running and not self._paused:
+                    dispatch(popleft())
+
+                if got is None:
+                    if self._running and AUTO_RECONNECT and disconnects<RECONNECT_MAX:
                         disconnects+=1
                         self.on_status(f"Disconnected — reconnecting ({disconnects}/{RECONNECT_MAX})…")
                         s=self._reconnect()
                         if s:
+                            self._sock=s
                             self.on_status("Reconnected.")
                             continue
                     break
 
-                if text:
-                    self._buf+=text
-                    while True:
-                        p=self._buf.find("\n")
-                        if p<0: break
-                        line=self._buf[:p]; self._buf=self._buf[p+1:]
-                        raw=line.rstrip("\r")
-                        if wire_fh:
-                            try:
-                                wire_fh.write(raw+"\n"); wire_fh.flush()
-                            except Exception:
-                                pass
-                        if self._paused:
-                            self._ring.append(raw); continue
-                        self._process_line_dispatch(raw)
-
                 self._run_pending_actions()
-                cur=self._first_unfinished_idx()
-                if cur is not None:
-                    self._scan_history_for_step(cur)
-
-                # periodic timeouts check
-                if _now_s()-last_timeout_check>TIMEOUT_TICK_INTERVAL:
-                    self._check_timeouts(); last_timeout_check=_now_s()
+                # history catch-up: at once when a new step becomes current, else at the idle cadence
+                cur=self._first_unfinished_idx(); now=_now_s()
+                if cur is not None and (cur!=last_scan_idx or now-last_scan>=IDLE_TICK_S):
+                    self._scan_history_for_step(cur); last_scan=now; last_scan_idx=cur
+
+                # timeouts: only once the nearest live deadline has passed (cached; O(1) otherwise)
+                dl=next_deadline()
+                if dl is not None and now>=dl:
+                    self._check_timeouts()
+                # current step finished this pass (history / timeout): catch up the next one without waiting
+                rescan=cur is not None and self._first_unfinished_idx()!=cur
 
                 if self._all_done():
                     self._running=False
-                time.sleep(IDLE_TICK_S)
 
         except Exception as e:
             self.on_status(f"Runner error: {e}\n{traceback.format_exc()}")
@@ -299,21 +671,19 @@ class SessionManager:
                 self._finalize_unfinished("stopped" if not self._running else "ended")
             except Exception:
                 pass
-            for fh in (wire_fh,_match_fh,_payload_fh,_ai_fh):
+            self._stop_log_writer()
+            self._adb.close()
+            for fh in (wire_fh,_match_fh,_payload_fh):   # _ai_fh: flushed by its own writer thread
                 try:
                     if fh: fh.flush()
-                except Exception:
+                except (OSError, ValueError):
                     pass
-            try:
-                if self._sock:
-                    try:
-                        self._sock.shutdown(socket.SHUT_RDWR)
-                    except Exception:
-                        pass
-                    self._sock.close()
-            except Exception:
-                pass
-            self._sock=None; self._running=False; self._paused=False
+            sock, self._sock = self._sock, None
+            if sock:
+                _shutdown_socket(sock)
+            self._close_selector()
+            self._buf.clear(); self._buf_scanned=0; self._ring.drain_partial(); self._in_lines.clear()
+            self._running=False; self._paused=False
             self.on_status("Stopped.")
 
             # Optional AI RCA
@@ -324,7 +694,7 @@ class SessionManager:
                         res=t.get("_final_result")
                         if res and res!="PASS":
                             failed.append({
-                                "_idx":i,"name":t.get("name",f"Step {i}"),
+                                "_idx":i,"name":t["_name"],
                                 "find":t.get("find"),"not_find":t.get("not_find"),
                                 "sequence":t.get("sequence"),"action":t.get("action"),
                                 "_final_result":res,"_final_line":t.get("_final_line"),
@@ -339,26 +709,28 @@ class SessionManager:
 
     # ---- Dispatch ---------------------------------------------------
     def _process_line_dispatch(self, line: str) -> None:
+        # Keep RAW line for matching history (rules may need headers)
+        self._payload_history.append(line); self._hist_total+=1
+
+        # payload is only needed for the tap, verbose debug, or matching live steps
+        matching = not LOG_ONLY_MODE and self._live
+        tap = _payload_fh is not None and self._log_thr is not None
+        if not (matching or tap or DEBUG_VERBOSE_RAW):
+            return
         try:
             _, _, _, payload_raw = tre.parse_dlt(line)
         except Exception:
             payload_raw = line
         payload = tre.sanitize_payload(payload_raw)
 
-        # Keep RAW line for matching history (rules may need headers)
-        self._payload_history.append(line)
-
-        if _payload_fh:
-            try:
-                _payload_fh.write(payload + "\n"); _payload_fh.flush()
-            except Exception:
-                pass
+        if tap:
+            self._log_q.put((_payload_fh, payload + "\n"))
 
         if DEBUG_VERBOSE_RAW and self._dbg_on(None, None):
             self._dbg(f"[RAW] {line[:220]}")
             self._dbg(f"[PAYLOAD] {payload}")
 
-        if LOG_ONLY_MODE:
+        if not matching:
             return
         if VERIFY_SEQUENTIAL:
             self._process_line_sequential(line, payload)
@@ -368,89 +740,217 @@ class SessionManager:
 
     # === Connect / I/O ==============================================
     def _connect_with_retries(self) -> Optional[socket.socket]:
-        last_err=None
-        for attempt in range(1,RETRY_MAX_ATTEMPTS+1):
+        # retries are bounded by a monotonic deadline; RETRY_MAX_ATTEMPTS is only a safety cap
+        last_err=None; attempt=0
+        deadline=_now_s()+CONNECT_RETRY_BUDGET_S
+        while True:
+            attempt+=1
             try:
                 self.on_status(f"Connecting to {self.host}:{self.port} (attempt {attempt})…")
-                s=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-                s.settimeout(CONNECT_TIMEOUT_SEC)
-                s.connect((self.host,self.port))
-                s.settimeout(None)
-                return s
+                # every resolved address raced in parallel; the winner is already non-blocking
+                return _connect_any(self.host,self.port,max(0.1,min(CONNECT_TIMEOUT_SEC,deadline-_now_s())),
+                                    cancel=self._stop_evt)
             except Exception as e:
-                last_err=e; delay=RETRY_BACKOFF_BASE_S*(2**(attempt-1))
+                last_err=e
+                if self._stop_evt.is_set():
+                    return None
+                if _is_permanent_connect_error(e):
+                    self.on_status(f"Connect failed: {e} — not retrying")
+                    return None
+                left=deadline-_now_s()
+                if left<=0 or attempt>=RETRY_MAX_ATTEMPTS:
+                    break
+                # full jitter: uniform(0, min(cap, base*2^n)), never past the deadline
+                delay=min(left,random.uniform(0,min(RETRY_BACKOFF_CAP_S,RETRY_BACKOFF_BASE_S*(2**min(attempt,5)))))
                 self.on_status(f"Connect failed: {e} — retrying in {delay:.1f}s")
-                time.sleep(delay)
-        self.on_status(f"Connect failed after {RETRY_MAX_ATTEMPTS} attempts: {last_err}")
+                if self._stop_evt.wait(delay):
+                    return None
+        self.on_status(f"Connect failed after {attempt} attempts: {last_err}")
         return None
 
     def _reconnect(self) -> Optional[socket.socket]:
-        try:
-            if self._sock: self._sock.close()
-        except Exception:
-            pass
-        self._sock=None
+        _invalidate_serial()
+        sock, self._sock = self._sock, None
+        if sock:
+            try: sock.close()
+            except OSError: pass
+        self._drop_partial()
         return self._connect_with_retries()
 
-    def _recv_block(self) -> Optional[str]:
-        if not self._sock:
+    def _drop_partial(self) -> None:
+        """Discard the unterminated tail of the old connection (buffer and ring) so it cannot
+        be glued onto the first line of the next one; complete lines are kept."""
+        tail=self._ring.drop_partial()+bytes(self._buf)
+        self._buf.clear(); self._buf_scanned=0
+        if tail:
+            self._dbg("dropped partial line on disconnect (%d bytes): %r" % (len(tail), str(tail[:200],"utf-8","ignore")))
+
+    def _recv_block(self) -> Optional[int]:
+        """Batch of recv_into calls appended to self._buf, up to RECV_BATCH_BYTES per wake-up;
+        bytes read (0 = nothing ready, None = EOF/error with nothing read)."""
+        sock=self._sock
+        if not sock:
             return None
+        view=self._rxview; buf=self._buf; cap=len(view); total=0
+        recv_into=sock.recv_into   # C method straight to the syscall (GIL released inside)
+        while total<RECV_BATCH_BYTES:
+            try:
+                n=recv_into(view)
+            except (BlockingIOError,InterruptedError):
+                break
+            except OSError:
+                return total or None
+            if not n:
+                return total or None   # EOF is reported on the next call
+            buf+=view[:n]; total+=n
+            if n<cap:
+                break   # short read: queue drained, skip the EAGAIN round-trip
+        return total
+
+    # --- selector: engine socket + wake-up pair (stop() interrupts the wait at once)
+    def _open_selector(self) -> None:
+        self._close_selector()
+        self._sel=selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False); self._wake_w.setblocking(False)
+        self._sel.register(self._wake_r, selectors.EVENT_READ)
+
+    def _close_selector(self) -> None:
+        sel, self._sel = self._sel, None; self._sel_sock=None
+        if sel:
+            try: sel.close()
+            except OSError: pass
+        for w in (self._wake_r, self._wake_w):
+            if w:
+                try: w.close()
+                except OSError: pass
+        self._wake_r=self._wake_w=None
+
+    def _wake(self) -> None:
+        w=self._wake_w
+        if w:
+            try: w.send(b"\0")
+            except OSError: pass
+
+    def _wait_readable(self, timeout: float) -> bool:
+        """One kernel wait for socket data, stop() wake-up or timeout; True if the socket is readable."""
+        sock=self._sock; sel=self._sel
+        if not sock:
+            return True   # let _recv_block report the disconnect
+        if sel is None:
+            return True
         try:
-            data=self._sock.recv(RECV_BLOCK_BYTES)
-            if not data:
-                return None
-            return data.decode("utf-8","ignore")
-        except (BlockingIOError,InterruptedError):
-            return ""
-        except OSError:
-            return None
-        except Exception:
-            raise
+            if self._sel_sock is not sock:
+                if self._sel_sock is not None:
+                    try: sel.unregister(self._sel_sock)
+                    except (KeyError,ValueError): pass
+                sel.register(sock, selectors.EVENT_READ); self._sel_sock=sock
+            ready=False
+            for key,_ in sel.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(64): pass
+                    except OSError:
+                        pass
+                else:
+                    ready=True
+            return ready
+        except (OSError,ValueError):
+            return True
 
-    def _drain_to_ring(self) -> None:
-        if not self._sock:
+    def _drain_nonblocking(self, sink: Optional[Callable[[memoryview], None]]) -> None:
+        """Read everything queued on the socket without blocking into sink (raw bytes);
+        sink=None discards the data."""
+        sock=self._sock
+        if not sock:
             return
-        self._sock.setblocking(False)
-        try:
-            while True:
-                try:
-                    data=self._sock.recv(RECV_BLOCK_BYTES)
-                except (BlockingIOError,InterruptedError,OSError):
-                    break
-                if not data:
-                    break
-                self._buf+=data.decode("utf-8","ignore")
-                while True:
-                    p=self._buf.find("\n")
-                    if p<0: break
-                    line=self._buf[:p]; self._buf=self._buf[p+1:]
-                    self._ring.append(line.rstrip("\r"))
-        finally:
+        # socket is non-blocking for the whole session (no setblocking toggles): recv until
+        # EAGAIN or a short read; errors/EOF are left for the live loop's _recv_block to report
+        # bounded like _recv_block: a sustained flood cannot hold a wait/settle tick past its deadline
+        view=self._rxview; cap=len(view); total=0
+        recv_into=sock.recv_into
+        while total<RECV_BATCH_BYTES:
             try:
-                self._sock.setblocking(True)
-            except Exception:
-                pass
+                n=recv_into(view)
+            except OSError:
+                break
+            if not n:
+                break
+            if sink is not None:
+                sink(view[:n])
+            total+=n
+            if n<cap:
+                break
+
+    def _take_lines(self) -> List[str]:
+        """Cut all complete lines off self._buf; one decode per batch, partial tail kept."""
+        buf=self._buf
+        # only bytes appended since the last call can hold a newline: a long partial line
+        # spanning many recvs is searched once, not once per recv
+        end=buf.rfind(b"\n",self._buf_scanned)
+        if end<0:
+            self._buf_scanned=len(buf)
+            return []
+        with memoryview(buf) as mv:   # decode in place: no bytes copy of the batch
+            text=str(mv[:end],"utf-8","ignore")
+        del buf[:end+1]   # front deletion is O(1) for bytearray (start offset moves)
+        self._buf_scanned=len(buf)
+        return _split_lines(text)
+
+    def _drain_to_ring(self) -> None:
+        # raw bytes straight into the ring; no per-line objects until drain()
+        self._drain_nonblocking(sink=self._ring.write)
 
     # === Matching logic =============================================
     def _first_unfinished_idx(self)->Optional[int]:
-        for i,t in enumerate(self.tests,start=1):
-            if not t.get("_done"): return i
-        return None
+        return self._live[0]+1 if self._live else None
 
-    def _normalize_cfg(self, cfg: Dict[str, Any]) -> Dict[str, Any]:
-        c = dict(cfg or {})
-        # Default stays True (back-compat), but the rule may set payload_only=False
-        if "payload_only" not in c:
-            c["payload_only"] = True
-        return c
 
+    def _compile_step(self, t: Dict[str, Any]) -> None:
+        """Resolve the step's match cfg(s) once per run (t['_pc'] / t['_seq_pc'] / t['_need']).
+        prepare_cfg reads the rule dicts without copying; payload_only defaults to True there."""
+        if "find" in t:
+            t["_pc"] = tre.prepare_cfg(t["find"] or {})
+            t["_need"] = int((t["find"] or {}).get("min_count", 1) or 1)
+        elif "not_find" in t:
+            t["_pc"] = tre.prepare_cfg(t["not_find"] or {})
+        elif "sequence" in t:
+            t["_seq_pc"] = [tre.prepare_cfg(n if isinstance(n, dict) else {"pattern": str(n), "literal": True})
+                            for n in (t.get("sequence", []) or [])]
+
+
+    def _build_needle_automaton(self):
+        """Aho-Corasick automaton over all literal needles (cumulative mode, pyahocorasick only)."""
+        if not AHO_OK or VERIFY_SEQUENTIAL:
+            return None
+        pcs: List[Dict[str, Any]] = []
+        for t in self.tests:
+            if "_pc" in t: pcs.append(t["_pc"])
+            pcs.extend(t.get("_seq_pc", ()))
+        needles = {pc["needle"] for pc in pcs if pc["needle"]}
+        if len(needles) < 2:
+            return None
+        try:
+            aho = ahocorasick.Automaton()
+            for nd in needles:
+                aho.add_word(nd, nd)
+            aho.make_automaton()
+            return aho
+        except Exception:
+            return None
+
+    def _line_needles(self, line: str) -> Optional[set]:
+        """Needles present in a clean ASCII line (one pass), or None when unknown."""
+        if self._aho is None or not (line.isascii() and line.isprintable()):
+            return None
+        return {nd for _, nd in self._aho.iter(line)}
 
-    def _try_find(self, idx: int, cfg: Dict[str, Any], line: str, payload: str, name: str) -> bool:
-        c = self._normalize_cfg(cfg)
-        need = int(c.get("min_count", 1)); have = self._counts.get(idx, 0)
+    def _try_find(self, idx: int, t: Dict[str, Any], line: str, payload: str, name: str) -> bool:
+        pc = t["_pc"]
+        need = t["_need"]; have = self._counts.get(idx, 0)
         if self._dbg_on(idx, name):
-            self._dbg(f"[FIND] step#{idx} need={need} have={have} pat='{c.get('pattern')}' | payload='{payload[:220]}'")
-        if tre.line_matches(line, c):  # RAW line
+            self._dbg(f"[FIND] step#{idx} need={need} have={have} pat='{pc['pattern']}' | payload='{payload[:220]}'")
+        if tre.match_prepared(line, pc):  # RAW line
             have += 1; self._counts[idx] = have
             if self._dbg_on(idx, name): self._dbg(f"[FIND] match count={have}")
             if have >= need:
@@ -459,18 +959,16 @@ class SessionManager:
 
 
     def _try_sequence(self, idx: int, t: Dict[str, Any], line: str, payload: str, name: str) -> bool:
-        seq = t.get("sequence", []) or []
-        prog = t.setdefault("_seq_idx", 0)
-        if prog >= len(seq):
+        seq_pc = t["_seq_pc"]
+        prog = t["_seq_idx"]
+        if prog >= len(seq_pc):
             return True
-        node = seq[prog]
-        c = node if isinstance(node, dict) else {"pattern": str(node), "literal": True}
-        c = self._normalize_cfg(c)
+        pc = seq_pc[prog]
         if self._dbg_on(idx, name):
-            self._dbg(f"[SEQ] step#{idx} prog={prog}/{len(seq)} pat='{c.get('pattern')}' | payload='{payload[:220]}'")
-        if tre.line_matches(line, c):  # RAW line
+            self._dbg(f"[SEQ] step#{idx} prog={prog}/{len(seq_pc)} pat='{pc['pattern']}' | payload='{payload[:220]}'")
+        if tre.match_prepared(line, pc):  # RAW line
             t["_seq_idx"] = prog + 1
-            return t["_seq_idx"] >= len(seq)
+            return t["_seq_idx"] >= len(seq_pc)
         return False
 
 
@@ -478,7 +976,7 @@ class SessionManager:
         idx = self._first_unfinished_idx()
         if idx is None:
             return
-        t = self.tests[idx - 1]; name = t.get("name", f"Step {idx}"); vc = self._describe_vc(t)
+        t = self.tests[idx - 1]; name = t["_name"]; vc = t["_vc"]
         self._hist[idx].append(payload)
         if t.get("_done"):
             return  # guard double emit
@@ -489,14 +987,13 @@ class SessionManager:
             return
 
         if "find" in t:
-            if self._try_find(idx, t["find"], line, payload, name):
+            if self._try_find(idx, t, line, payload, name):
                 if not t.get("_done"):
                     t["_done"] = True; self._emit(idx, name, vc, "PASS", line)
             return
 
         if "not_find" in t:
-            cfg = self._normalize_cfg(t["not_find"])
-            if tre.line_matches(line, cfg):  # RAW line
+            if tre.match_prepared(line, t["_pc"]):  # RAW line
                 if not t.get("_done"):
                     t["_done"] = True; self._emit(idx, name, vc, "FAIL", line)
             return
@@ -512,23 +1009,36 @@ class SessionManager:
 
 
     def _process_line_cumulative(self, line: str, payload: str) -> None:
-        for idx0, t in enumerate(self.tests):
+        # one pass per line: automaton hit-set if available, else plain substring checks on clean lines
+        found = self._line_needles(line)
+        clean = found is None and line.isascii() and line.isprintable()
+        tests = self.tests
+        self._hist_live.append(payload)   # one append for all live steps
+        for idx0 in tuple(self._live):   # _emit() shrinks _live as steps finish
+            t = tests[idx0]
             if t.get("_done"):
                 continue
-            idx = idx0 + 1; name = t.get("name", f"Step {idx}"); vc = self._describe_vc(t)
-            self._hist[idx].append(payload)
+            idx = idx0 + 1; name = t["_name"]; vc = t["_vc"]
 
             if "action" in t:
                 continue  # actions executed by _run_pending_actions()
 
+            if found is not None or clean:
+                pc = t.get("_pc")
+                if pc is None and "_seq_pc" in t:
+                    prog = t.get("_seq_idx", 0)
+                    pc = t["_seq_pc"][prog] if prog < len(t["_seq_pc"]) else None
+                nd = pc["needle"] if pc is not None else None
+                if nd and nd not in (found if found is not None else line):
+                    continue  # literal needle absent: cannot match this line
+
             if "find" in t:
-                if self._try_find(idx, t["find"], line, payload, name):
+                if self._try_find(idx, t, line, payload, name):
                     t["_done"] = True; self._emit(idx, name, vc, "PASS", line)
                 continue
 
             if "not_find" in t:
-                cfg = self._normalize_cfg(t["not_find"])
-                if tre.line_matches(line, cfg):  # RAW line
+                if tre.match_prepared(line, t["_pc"]):  # RAW line
                     t["_done"] = True; self._emit(idx, name, vc, "FAIL", line)
                 continue
 
@@ -548,34 +1058,42 @@ class SessionManager:
         if t.get("_done") or "action" in t:
             return
 
-        name = t.get("name", f"Step {idx}"); vc = self._describe_vc(t)
+        name = t["_name"]; vc = t["_vc"]
 
-        def _norm(cfg: Dict[str, Any]) -> Dict[str, Any]:
-            c = dict(cfg or {}); 
-            if "payload_only" not in c: c["payload_only"] = True
-            return c
+        # each history line is checked once per step: resume after the last scanned position
+        total = self._hist_total; kept = len(self._payload_history)
+        start = max(self._scan_pos.get(idx, 0), total - kept)
+        if start >= total:
+            return
+        self._scan_pos[idx] = total
+        # RAW lines; not appended to while we scan. first_match_index_prepared rejects the
+        # whole batch with one joined needle / required-word scan before any per-line match
+        hist = list(islice(self._payload_history, start - (total - kept), None))
+        first = tre.first_match_index_prepared
 
-        for raw in list(self._payload_history):  # RAW lines now
-            if t.get("_done"):
-                return
-            if "find" in t:
-                if tre.line_matches(raw, _norm(t["find"])):
-                    t["_done"] = True; self._emit(idx, name, vc, "PASS", raw); return
-            elif "not_find" in t:
-                if tre.line_matches(raw, _norm(t["not_find"])):
-                    t["_done"] = True; self._emit(idx, name, vc, "FAIL", raw); return
-            elif "sequence" in t:
-                seq = t.get("sequence", []) or []
-                prog = t.setdefault("_seq_idx", 0)
-                if prog >= len(seq):
-                    t["_done"] = True; self._emit(idx, name, vc, "PASS", ""); return
-                node = seq[prog]
-                c = node if isinstance(node, dict) else {"pattern": str(node), "literal": True}
-                c = _norm(c)
-                if tre.line_matches(raw, c):
-                    t["_seq_idx"] = prog + 1
-                    if t["_seq_idx"] >= len(seq):
-                        t["_done"] = True; self._emit(idx, name, vc, "PASS", raw); return
+        if "not_find" in t:
+            hit = first(hist, t["_pc"])
+            if hit is not None:
+                t["_done"] = True; self._emit(idx, name, vc, "FAIL", hist[hit])
+            return
+
+        if "find" in t:
+            hit = first(hist, t["_pc"])
+            if hit is not None:
+                t["_done"] = True; self._emit(idx, name, vc, "PASS", hist[hit])
+        elif "sequence" in t:
+            # only the awaited node is tried; each node resumes after the previous node's line
+            seq_pc = t["_seq_pc"]; n = len(seq_pc); prog = t["_seq_idx"]
+            if prog >= n:
+                t["_done"] = True; self._emit(idx, name, vc, "PASS", ""); return
+            pos = 0
+            while True:
+                hit = first(hist, seq_pc[prog], pos)
+                if hit is None:
+                    return
+                prog += 1; t["_seq_idx"] = prog; pos = hit + 1
+                if prog >= n:
+                    t["_done"] = True; self._emit(idx, name, vc, "PASS", hist[hit]); return
 
 
     # === Timeouts / finalize / emit / VC =============================
@@ -587,29 +1105,37 @@ class SessionManager:
     def _check_timeouts(self)->None:
         if not self._running:
             return
-        now=_now_s()
-        for idx,t in enumerate(self.tests,1):
-            if t.get("_done"):
-                continue
-            t0=t.get("_t0") or now; t["_t0"]=t0
-            tmo=self._current_timeout_s(idx,t)
-            if tmo<=0 or (now-t0)<tmo:
+        now=_now_s(); tests=self.tests
+        for idx0 in tuple(self._live):
+            t=tests[idx0]; dl=t["_deadline"]
+            if dl is None or now<dl:
                 continue
-            name=t.get("name",f"Step {idx}"); vc=self._describe_vc(t)
-            if "not_find" in t:
-                t["_done"]=True; self._emit(idx,name,vc,"PASS",f"[timeout {tmo:.0f}s: pattern not seen]")
-            elif "action" in t:
-                t["_done"]=True; self._emit(idx,name,vc,"FAIL",f"[timeout {tmo:.0f}s on action]")
-            else:
-                t["_done"]=True; self._emit(idx,name,vc,"FAIL",f"[timeout {tmo:.0f}s]")
+            res,msg=t["_on_timeout"]
+            t["_done"]=True; self._emit(idx0+1,t["_name"],t["_vc"],res,msg)
+
+    def _timeout_outcome(self, t:Dict[str,Any], tmo:float)->Tuple[str,str]:
+        """(result, message) reported when the step's deadline passes; fixed per run."""
+        if "not_find" in t:
+            return "PASS", f"[timeout {tmo:.0f}s: pattern not seen]"
+        if "action" in t:
+            return "FAIL", f"[timeout {tmo:.0f}s on action]"
+        return "FAIL", f"[timeout {tmo:.0f}s]"
+
+    def _next_deadline(self)->Optional[float]:
+        # recomputed only after a step finished (_emit marks it dirty); deadlines are fixed per run
+        if self._dl_dirty:
+            tests=self.tests
+            dls=[tests[i]["_deadline"] for i in self._live if tests[i]["_deadline"] is not None]
+            self._dl_next=min(dls) if dls else None; self._dl_dirty=False
+        return self._dl_next
 
     def _all_done(self)->bool:
-        return all(t.get("_done") for t in self.tests)
+        return not self._live
 
     def _finalize_unfinished(self,reason:str="stopped")->None:
-        for i,t in enumerate(self.tests,1):
-            if t.get("_done"): continue
-            name=t.get("name",f"Step {i}"); vc=self._describe_vc(t)
+        for idx0 in tuple(self._live):
+            i=idx0+1; t=self.tests[idx0]
+            name=t["_name"]; vc=t["_vc"]
             if "not_find" in t:
                 t["_done"]=True; self._emit(i,name,vc,"PASS",f"[{reason}: pattern not seen]")
             else:
@@ -617,11 +1143,19 @@ class SessionManager:
 
     def _emit(self, idx: int, name: str, vc: str, result: str, line: Optional[str]):
         try:
-            if self.on_step_update:
-                self.on_step_update(idx, name, vc, result, line)
+            try: self._live.remove(idx - 1)
+            except ValueError: pass
+            self._dl_dirty = True
+            if not VERIFY_SEQUENTIAL:
+                self._hist[idx] = collections.deque(self._hist_live, maxlen=HISTORY_MAX_PER_STEP)
             t = self.tests[idx - 1]
             t["_final_result"] = result
             t["_final_line"] = line
+            try:
+                # straight to the UI: a finished step is never held behind an action (Tk side coalesces repaints)
+                self.on_step_update(idx, name, vc, result, line)
+            except Exception:
+                pass
             if result != "PASS":
                 # Add a short reason (line if present), then dump last raw lines
                 snippet = (line or "") if isinstance(line, str) else ""
@@ -631,8 +1165,8 @@ class SessionManager:
 
 
     def _describe_vc(self,t:Dict[str,Any])->str:
-        if "find" in t: return str(t["find"].get("pattern",""))
-        if "not_find" in t: return f"NOT {t['not_find'].get('pattern','')}"
+        if "find" in t: return str((t["find"] or {}).get("pattern",""))
+        if "not_find" in t: return f"NOT {(t['not_find'] or {}).get('pattern','')}"
         if "sequence" in t:
             seq=t.get("sequence",[]); pats=[n if isinstance(n,str) else n.get("pattern","") for n in seq]
             return " | ".join(pats)
@@ -656,8 +1190,8 @@ class SessionManager:
                 continue
             if "action" not in t:
                 break
-            name = t.get("name", f"Step {i}")
-            vc   = self._describe_vc(t)
+            name = t["_name"]
+            vc   = t["_vc"]
             ok, msg = self._perform_action(t["action"])
             t["_done"] = True
             self._emit(i, name, vc, ("PASS" if ok else "FAIL"), msg)
@@ -669,39 +1203,36 @@ class SessionManager:
         # WAIT
         if at == "wait":
             ms = int(action.get("ms", 0))
-            end_t = _now_s() + (ms / 1000.0)
-            while self._running and _now_s() < end_t:
-                self._drain_discard_once(); time.sleep(WAIT_DRAIN_TICK_S)
+            self._wait_drain(_now_s() + (ms / 1000.0), self._drain_discard_once)
             return True, f"wait {ms}ms"
 
         # WAIT_CAPTURE
         if at == "wait_capture":
             ms = int(action.get("ms", 0))
-            end_t = _now_s() + (ms / 1000.0)
-            captured: List[str] = []
-            while self._running and _now_s() < end_t:
-                captured.extend(self._drain_collect_once()); time.sleep(WAIT_DRAIN_TICK_S)
-            if captured: self._prefeed_lines = captured + self._prefeed_lines
+            self._wait_drain(_now_s() + (ms / 1000.0), self._drain_collect_once)
+            captured = self._take_lines()   # one decode/split for the whole window
+            if captured: self._in_lines.extend(captured)   # after anything already queued (arrival order)
             return True, f"wait_capture {ms}ms ({len(captured)} lines)"
 
         # SCREENSHOT
         if at == "screenshot":
             shots_dir = os.path.join(self.out_dir, "Screenshots")
             os.makedirs(shots_dir, exist_ok=True)
-            fn = action.get("file") or f"shot_{datetime.datetime.now():%Y-%m-%d_%H-%M-%S}.png"
+            fn = action.get("file") or "shot_" + time.strftime("%Y-%m-%d_%H-%M-%S") + ".png"
             fn = os.path.basename(str(fn)); out_path = os.path.join(shots_dir, fn)
             if ANDROID_OK:
                 try:
-                    droid.ensure_server(); ser = droid.get_default_device_serial()
+                    droid.ensure_server(); ser = _serial()
                     if not ser: return False, "No Android device"
                     ok = droid.screencap_png_to(out_path, serial=ser) \
                          if hasattr(droid, "screencap_png_to") else _compat_screencap_to(out_path)
-                    if not ok or not os.path.exists(out_path): return False, f"screenshot failed: {out_path}"
+                    if not ok or not os.path.exists(out_path):
+                        _invalidate_serial(); return False, f"screenshot failed: {out_path}"
                     return True, f"{out_path}"
                 except Exception as e:
                     return False, f"screenshot error: {e}"
             else:
-                ok = _AdbDirect("adbb").screencap_png_to(out_path)
+                ok = self._adb.screencap_png_to(out_path)
                 return (ok, out_path if ok else "screenshot failed")
 
         # TAP
@@ -710,14 +1241,15 @@ class SessionManager:
             if x < 0 or y < 0: return False, "tap needs x/y"
             if ANDROID_OK:
                 try:
-                    droid.ensure_server(); ser = droid.get_default_device_serial()
+                    droid.ensure_server(); ser = _serial()
                     if not ser: return False, "No Android device"
                     ok = droid.input_tap(x, y, serial=ser)
+                    if not ok: _invalidate_serial()
                     return ok, f"tap({x},{y}) {'ok' if ok else 'fail'}"
                 except Exception as e:
                     return False, f"tap error: {e}"
             else:
-                ok = _AdbDirect("adbb").tap(x, y); return ok, f"tap({x},{y}) {'ok' if ok else 'fail'}"
+                ok = self._adb.tap(x, y); return ok, f"tap({x},{y}) {'ok' if ok else 'fail'}"
 
         # TAP_PCT
         if at == "tap_pct":
@@ -725,7 +1257,7 @@ class SessionManager:
             if not (0 <= px <= 1 and 0 <= py <= 1): return False, "tap_pct needs px/py in [0..1]"
             try:
                 if ANDROID_OK:
-                    droid.ensure_server(); ser = droid.get_default_device_serial()
+                    droid.ensure_server(); ser = _serial()
                     if not ser: return False, "No Android device"
                     # try device size
                     w,h = 0,0
@@ -739,12 +1271,13 @@ class SessionManager:
                     if w<=0 or h<=0: return False, "unknown device size"
                     x = int(round(px * w)); y = int(round(py * h))
                     ok = droid.input_tap(x, y, serial=ser)
+                    if not ok: _invalidate_serial()
                     return ok, f"tap_pct({px:.2f},{py:.2f})=>({x},{y}) {'ok' if ok else 'fail'}"
                 else:
                     w,h = self._guess_wm_size()
                     if w<=0 or h<=0: return False, "unknown device size"
                     x = int(round(px * w)); y = int(round(py * h))
-                    ok = _AdbDirect("adbb").tap(x, y)
+                    ok = self._adb.tap(x, y)
                     return ok, f"tap_pct({px:.2f},{py:.2f})=>({x},{y}) {'ok' if ok else 'fail'}"
             except Exception as e:
                 return False, f"tap_pct error: {e}"
@@ -752,58 +1285,30 @@ class SessionManager:
         return False, f"unknown action: {at}"
 
     # Wait drain helpers
+    def _wait_drain(self, end_t: float, drain: Callable[[], None]) -> None:
+        """Until end_t: sleep in the selector while idle, drain at most once per WAIT_DRAIN_TICK_S
+        while data flows; stop() interrupts both waits."""
+        while self._running:
+            rem = end_t - _now_s()
+            if rem <= 0:
+                return
+            if self._wait_readable(rem):
+                drain()
+                rem = end_t - _now_s()
+                if rem > 0 and self._stop_evt.wait(min(WAIT_DRAIN_TICK_S, rem)):
+                    return
+
     def _drain_discard_once(self) -> None:
-        if not self._sock:
-            return
-        try:
-            self._sock.setblocking(False)
-            while True:
-                try:
-                    _ = self._sock.recv(RECV_BLOCK_BYTES)
-                except (BlockingIOError, InterruptedError):
-                    break
-                except OSError:
-                    break
-                if not _:
-                    break
-        finally:
-            try:
-                self._sock.setblocking(True)
-            except Exception:
-                pass
+        self._drain_nonblocking(None)
 
-    def _drain_collect_once(self) -> List[str]:
-        out: List[str] = []
-        if not self._sock:
-            return out
-        local = ""
-        try:
-            self._sock.setblocking(False)
-            while True:
-                try:
-                    data = self._sock.recv(RECV_BLOCK_BYTES)
-                except (BlockingIOError, InterruptedError):
-                    break
-                except OSError:
-                    break
-                if not data:
-                    break
-                local += data.decode("utf-8", errors="ignore")
-                while True:
-                    p = local.find("\n")
-                    if p < 0: break
-                    one = local[:p]; local = local[p+1:]
-                    out.append(one.rstrip("\r"))
-            if local:
-                self._buf += local
-        finally:
-            try:
-                self._sock.setblocking(True)
-            except Exception:
-                pass
-        return out
+    def _drain_collect_once(self) -> None:
+        # raw bytes accumulate in self._buf; lines are cut once when the capture ends
+        self._drain_nonblocking(sink=self._buf.extend)
 
     def _guess_wm_size(self) -> Tuple[int,int]:
+        wh = self._adb.wm_size()
+        if wh[0] > 0 and wh[1] > 0:
+            return wh
         try:
             out = subprocess.check_output(["adbb","shell","wm","size"],
                                           stderr=subprocess.STDOUT, timeout=1.5).decode("utf-8","ignore")
@@ -811,27 +1316,74 @@ class SessionManager:
                 if ":" in ln and "x" in ln:
                     tail=ln.split(":",1)[1].strip()
                     w,h=tail.split("x"); return (int(w),int(h))
-        except Exception:
+        except (OSError, subprocess.SubprocessError, ValueError):
             pass
         return (0,0)
 
 # === CHUNK 9 — Android compat screencap helper =======================
+SERIAL_CACHE_TTL_S = 30.0
+_SERIAL_CACHE: Dict[str, Any] = {"v": None, "t": 0.0}
+
+def _serial() -> Optional[str]:
+    """droid.get_default_device_serial() (an 'adb devices' call), cached for SERIAL_CACHE_TTL_S."""
+    now = time.monotonic()
+    if _SERIAL_CACHE["v"] and now - _SERIAL_CACHE["t"] < SERIAL_CACHE_TTL_S:
+        return _SERIAL_CACHE["v"]
+    v = droid.get_default_device_serial()
+    _SERIAL_CACHE.update(v=v, t=now)
+    return v
+
+def _invalidate_serial() -> None:
+    _SERIAL_CACHE.update(v=None, t=0.0)
+
+_ADB_WHICH: Dict[str, Optional[str]] = {}
+
+def _exec_out_screencap(out_path: str, serial: Optional[str]) -> Optional[bool]:
+    """'adb exec-out screencap -p' piped straight into out_path (no temp file / rename).
+    None = could not run (adb or serial unresolved); False = ran and failed."""
+    exe = droid.get_adb_executable()
+    if exe not in _ADB_WHICH:
+        _ADB_WHICH[exe] = shutil.which(exe)
+    if not _ADB_WHICH[exe] or not serial:
+        return None
+    args = ["-s", serial] if serial else []
+    ok = False
+    try:
+        with open(out_path, "wb") as f:
+            p = subprocess.Popen([_ADB_WHICH[exe]] + args + ["exec-out", "screencap", "-p"],
+                                 stdout=f, stderr=subprocess.DEVNULL)
+            try:
+                rc = p.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                p.kill(); p.wait(); rc = -1
+        if rc == 0 and os.path.getsize(out_path) > 1024:
+            with open(out_path, "rb") as f:
+                ok = f.read(8) == b"\x89PNG\r\n\x1a\n"
+    except OSError:
+        ok = False
+    if not ok:
+        try: os.remove(out_path)
+        except OSError: pass
+    return ok
+
 def _compat_screencap_to(out_path: str) -> bool:
     try:
+        ser = _serial()
+        ok = _exec_out_screencap(out_path, ser)
+        if ok is not None:
+            return ok   # it ran: a failed capture is a failure, not a second adb attempt
+        # fallback (exec-out unavailable): droid.screencap_png to a temp file, then install it
         tmp_dir = os.path.dirname(out_path) or "."
-        ser = droid.get_default_device_serial()
         tmp = droid.screencap_png(tmp_dir, prefix="__tmp__", serial=ser)
         if not tmp or not os.path.exists(tmp): return False
-        import shutil
         try:
-            shutil.move(tmp, out_path)
-        except Exception:
-            with open(tmp, "rb") as src, open(out_path, "wb") as dst:
-                dst.write(src.read())
+            os.replace(tmp, out_path)   # atomic rename: tmp sits next to out_path
+        except OSError:
             try:
                 os.remove(tmp)
-            except Exception:
+            except OSError:
                 pass
+            return False
         return True
     except Exception:
         return False
@@ -745,16 +745,35 @@ class TREApp:
         self._online_prog.start(10)
 
         def on_steps_init(steps):
-            for st in steps:
-                iid = self._on_progress_add(st["idx"], st["name"], st.get("vc",""))
+            for idx, name, vc in steps:
+                iid = self._on_progress_add(idx, name, vc or "")
                 # map idx->iid
-                self._online_row_iids[int(st["idx"])] = iid
+                self._online_row_iids[int(idx)] = iid
 
         def on_step_update(i, name, vc, result, line):
             iid = self._online_row_iids.get(int(i))
             if iid:
                 self._on_progress_set(iid, result, line)
 
+        # engine thread -> UI: coalesce step updates into one Tk callback per ~frame (16 ms)
+        pending_updates: List[Tuple] = []
+        pending_lock = threading.Lock()
+        flush_armed = [False]
+
+        def flush_updates():
+            with pending_lock:
+                batch = pending_updates[:]; pending_updates.clear(); flush_armed[0] = False
+            for args in batch:
+                on_step_update(*args)
+
+        def queue_update(i, n, v, r, l):
+            with pending_lock:
+                pending_updates.append((i, n, v, r, l))
+                if flush_armed[0]:
+                    return
+                flush_armed[0] = True
+            self.root.after(16, flush_updates)
+
         self._online_row_iids = {}
         mgr = SessionManager(
             host=host,
@@ -763,7 +782,7 @@ class TREApp:
             out_dir=out_dir,
             on_status=lambda m: self.root.after(0, self._online_status.set, m),
             on_steps_init=lambda s: self.root.after(0, on_steps_init, s),
-            on_step_update=lambda i,n,v,r,l: self.root.after(0, on_step_update, i,n,v,r,l),
+            on_step_update=queue_update,
         )
         with self._online_lock:
             self._online_mgr = mgr